@@ -4,45 +4,125 @@ FastAPI application providing endpoints to analyze tea images and health check.
 This module is formatted to satisfy pylint and provides explicit response models.
 """
 
+import asyncio
+import hashlib
 import io
+import itertools
 import logging
-import random
+import queue
 import sys
-import traceback
+import threading
+from logging.handlers import QueueHandler, QueueListener
 
+import numpy as np
+from cachetools import LRUCache
 from PIL import Image
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi import FastAPI, Request, Response, UploadFile, File, HTTPException
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 
 from pydantic import BaseModel
 
+# libvipsが利用可能ならshrink-on-load対応の高速デコードを使用する
+# （未導入の環境ではPILのパスにフォールバック）
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
 # ロギングの設定を強化
+# ハンドラへの書き込み（特にapp.logへの同期ディスクI/O）は
+# QueueListenerの専用スレッドに退避し、リクエスト処理をブロックしない
+_log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+_stream_handler = logging.StreamHandler(sys.stdout)
+_stream_handler.setFormatter(_log_formatter)
+_file_handler = logging.FileHandler('app.log')
+_file_handler.setFormatter(_log_formatter)
+
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, _stream_handler, _file_handler)
+_log_listener.start()
+
+# QueueHandler側はメッセージのみを整形し、
+# 最終的なフォーマットはリスナー側のハンドラに任せる
 logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('app.log')
-    ]
+    level=logging.INFO,
+    format='%(message)s',
+    handlers=[QueueHandler(_log_queue)],
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
-
-# CORSミドルウェアの設定
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:3000", "http://localhost:3001"],
-    allow_credentials=False,
-    allow_methods=["GET", "POST", "OPTIONS"],
-    allow_headers=["*"],
-    expose_headers=["Content-Length", "Content-Type"],
-)
+# レスポンスのシリアライズはorjson（SIMD対応のRust実装）で行う
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# 512バイト以上のレスポンスボディをgzip圧縮する
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
+# CORSの設定
+# オリジンは固定なので、汎用のCORSMiddlewareではなく
+# frozenset照合＋プリフライト即応答の最小ミドルウェアで処理する
+_ALLOWED_ORIGINS = frozenset({"http://localhost:3000", "http://localhost:3001"})
+_PREFLIGHT_HEADERS = {
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "*",
+    "Access-Control-Max-Age": "600",
+}
+
+
+def _append_vary_origin(response: Response) -> None:
+    """VaryヘッダにOriginを追加する
+
+    Allow-Originはオリジンごとに異なるため、共有キャッシュが別オリジン
+    宛てのレスポンスを使い回さないようVary: Originを必ず付ける。
+    """
+    vary = response.headers.get("Vary")
+    response.headers["Vary"] = f"{vary}, Origin" if vary else "Origin"
+
+
+@app.middleware("http")
+async def cors_middleware(request: Request, call_next) -> Response:
+    """固定オリジン向けの最小CORSミドルウェア"""
+    origin = request.headers.get("origin")
+    if origin not in _ALLOWED_ORIGINS:
+        response = await call_next(request)
+        _append_vary_origin(response)
+        return response
+
+    # プリフライトはルーターに渡さず即座に応答する
+    if request.method == "OPTIONS":
+        headers = dict(_PREFLIGHT_HEADERS)
+        headers["Access-Control-Allow-Origin"] = origin
+        headers["Vary"] = "Origin"
+        return Response(status_code=204, headers=headers)
+
+    response = await call_next(request)
+    response.headers["Access-Control-Allow-Origin"] = origin
+    response.headers["Access-Control-Expose-Headers"] = "Content-Length, Content-Type"
+    _append_vary_origin(response)
+    return response
 
 # 茶葉の品種リスト
 TEA_VARIETIES = ["やぶきた", "さえみどり", "つゆひかり"]
 TEA_GRADES = ["優良", "中等", "低級"]
 
+# エラーメッセージはモジュール定数として使い回す
+_ERR_OVERSIZE = "ファイルサイズは5MB以下にしてください"
+_ERR_UNSUPPORTED_FORMAT = "JPEGまたはPNG形式の画像のみ対応しています"
+
+# モック推論用の乱数リングバッファ
+# リクエストごとにPythonレベルのRNGを3回呼ぶ代わりに、
+# 起動時にまとめて生成した (品種, 等級, 信頼度) を順に読み出す
+_RING_SIZE = 65536  # 2の冪（カウンタのマスクに使う）
+_RING = np.stack(
+    [
+        np.random.randint(0, len(TEA_VARIETIES), _RING_SIZE),
+        np.random.randint(0, len(TEA_GRADES), _RING_SIZE),
+        np.random.uniform(0.7, 1.0, _RING_SIZE).round(3),
+    ],
+    axis=1,
+)
+_RING_COUNTER = itertools.count()
+
 
 class AnalyzeResponse(BaseModel):
     """分析結果のレスポンスモデル"""
@@ -59,27 +139,49 @@ class HealthResponse(BaseModel):
     message: str
 
 
+# 透過画像の合成用に事前確保した白背景
+# サムネイル後の画像は400x400以下なので、リクエストごとにImage.newで
+# 確保・塗りつぶしせず、これをcropして使い回す
+_WHITE_BACKGROUND = Image.new("RGBA", (400, 400), (255, 255, 255, 255))
+
+
 def log_and_raise_http_error(error_msg: str, err: Exception, status_code: int) -> None:
     """エラーログを出力してHTTPExceptionを発生させる共通関数"""
-    logger.error("%s: %s", error_msg, str(err))
-    logger.error(traceback.format_exc())
+    # logger.exceptionはレコードが実際に出力される場合のみ
+    # トレースバックを整形する
+    logger.exception(error_msg)
     raise HTTPException(status_code=status_code, detail=error_msg) from err
 
 
 def optimize_image(image: Image.Image, max_size: tuple[int, int] = (400, 400)) -> Image.Image:
     """画像を最適化する"""
+    # DEBUG無効時は引数の評価ごとスキップする
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
     try:
-        logger.debug("画像最適化開始 - 元のサイズ: %s", image.size)
-
+        if debug_enabled:
+            logger.debug("画像最適化開始 - 元のサイズ: %s", image.size)
+
+        # JPEGはdraft()でlibjpegのDCTスケーリングを有効にし、
+        # 1/2・1/4・1/8解像度でデコードしてからリサイズする
+        if image.format == "JPEG":
+            image.draft("RGB", max_size)
+            if debug_enabled:
+                logger.debug("draft適用後のサイズ: %s", image.size)
+
+        # draft()済みの入力は目標解像度に近いため、6タップのLANCZOSではなく
+        # 4タップのBICUBICで十分な品質が得られる
         if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
-            image.thumbnail(max_size, Image.Resampling.LANCZOS)
-            logger.debug("画像をリサイズ - 新しいサイズ: %s", image.size)
+            image.thumbnail(max_size, Image.Resampling.BICUBIC)
+            if debug_enabled:
+                logger.debug("画像をリサイズ - 新しいサイズ: %s", image.size)
 
         # メモリ使用量を最適化
+        # alpha_compositeはsplit+pasteより少ないパスで白背景に合成できる
         if image.mode in ("RGBA", "LA"):
-            background = Image.new("RGB", image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1])
-            image = background
+            if image.mode == "LA":
+                image = image.convert("RGBA")
+            background = _WHITE_BACKGROUND.crop((0, 0, image.size[0], image.size[1]))
+            image = Image.alpha_composite(background, image).convert("RGB")
             logger.debug("透過画像をRGBに変換")
 
         return image
@@ -87,6 +189,182 @@ def optimize_image(image: Image.Image, max_size: tuple[int, int] = (400, 400)) -
         log_and_raise_http_error("画像最適化エラー", err, 500)
         return None  # この行は実行されないが、型チェッカーのために追加
 
+def image_to_planar_array(image: Image.Image) -> np.ndarray:
+    """最適化済み画像を推論用のCHW uint8配列に変換する
+
+    PILのHWC（ピクセル単位）レイアウトから、MLモデルが前提とする
+    チャネルごとに連続したプレーナレイアウトへ一度だけ変換しておく。
+    実モデル導入時はこの戻り値をそのまま入力テンソルとして渡す。
+    """
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray(image, dtype=np.uint8).transpose(2, 0, 1).copy()
+
+
+def _image_format(contents: bytes) -> str:
+    """先頭のマジックバイトから画像フォーマットを判定する
+
+    デコードを伴わないため、非対応フォーマットは数バイトの比較だけで弾ける。
+    """
+    if contents[:3] == b"\xff\xd8\xff":
+        return "JPEG"
+    if contents[:8] == b"\x89PNG\r\n\x1a\n":
+        return "PNG"
+    raise HTTPException(status_code=400, detail=_ERR_UNSUPPORTED_FORMAT)
+
+
+# ワーカースレッドごとに使い回すデコード用バッファ
+_tls = threading.local()
+
+
+def _decode_buffer(contents: bytes) -> io.BytesIO:
+    """スレッドローカルなBytesIOにcontentsを書き込んで返す
+
+    リクエストごとのBytesIO割り当てを省くため、同一スレッド内で
+    バッファを再利用する。
+    """
+    buf = getattr(_tls, "buf", None)
+    if buf is None:
+        buf = _tls.buf = io.BytesIO()
+    buf.seek(0)
+    buf.truncate()
+    buf.write(contents)
+    buf.seek(0)
+    return buf
+
+
+def _decode_and_optimize(contents: bytes) -> tuple[str, tuple[int, int]]:
+    """画像のデコードと最適化を行い、(フォーマット, サイズ) を返す
+
+    CPUバウンドな処理のため、イベントループ上ではなく
+    ワーカースレッドから呼び出すこと。
+    """
+    # 画像フォーマットの検証（マジックバイトのみで判定し、デコードは行わない）
+    image_format = _image_format(contents)
+
+    if pyvips is not None:
+        # libvipsはデコードとリサイズを融合するため、縮小後のピクセルしか展開しない
+        try:
+            vimg = pyvips.Image.thumbnail_buffer(contents, 400, height=400, size="down")
+            # 白背景合成もパイプラインに融合する。評価はタイル単位で
+            # ストリーミングされ、パスごとの中間バッファを持たない
+            if vimg.hasalpha():
+                vimg = vimg.flatten(background=[255, 255, 255])
+        except pyvips.Error as err:
+            log_and_raise_http_error("画像の読み込みに失敗しました", err, 400)
+
+        # モック推論はピクセルを参照しないため、ここではパイプラインを
+        # 実体化（write_to_memory）せずメタデータだけ返す
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("libvipsでデコード - サイズ: %dx%d", vimg.width, vimg.height)
+        return image_format, (vimg.width, vimg.height)
+
+    try:
+        image = Image.open(_decode_buffer(contents))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("画像フォーマット: %s, サイズ: %s, モード: %s", image.format, image.size, image.mode)
+    except Exception as err:  # pylint: disable=broad-except
+        log_and_raise_http_error("画像の読み込みに失敗しました", err, 400)
+
+    # 画像の最適化
+    try:
+        image = optimize_image(image)
+    except Exception as err:  # pylint: disable=broad-except
+        log_and_raise_http_error("画像の最適化に失敗しました", err, 500)
+
+    return image_format, image.size
+
+
+class AsyncBatchQueue:
+    """同時リクエストのデコード処理をまとめるマイクロバッチキュー
+
+    バースト時に複数アップロードを1回のスレッドプール投入に束ねることで、
+    リクエストごとのディスパッチオーバーヘッドを償却する。
+    """
+
+    def __init__(self, max_batch_size: int = 8, max_wait_time: float = 0.01) -> None:
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        """バッチ収集ループを起動する"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """バッチ収集ループを停止する"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, contents: bytes) -> tuple[str, tuple[int, int]]:
+        """画像データをキューに投入し、デコード結果を待つ"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((contents, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_time
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            results = await asyncio.to_thread(
+                self._process_batch, [contents for contents, _ in batch]
+            )
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    @staticmethod
+    def _process_batch(batch: list[bytes]) -> list:
+        """バッチ内の各画像を順にデコードする（ワーカースレッドで実行）"""
+        results = []
+        for contents in batch:
+            try:
+                results.append(_decode_and_optimize(contents))
+            except Exception as err:  # pylint: disable=broad-except
+                results.append(err)
+        return results
+
+
+batch_queue = AsyncBatchQueue()
+
+# 同一内容の再アップロード用の結果キャッシュ（SHA-256ダイジェストがキー）
+analyze_cache: LRUCache = LRUCache(maxsize=256)
+analyze_cache_lock = asyncio.Lock()
+
+
+@app.on_event("startup")
+async def start_batch_queue() -> None:
+    """アプリ起動時にバッチキューを開始する"""
+    await batch_queue.start()
+
+
+@app.on_event("shutdown")
+async def stop_batch_queue() -> None:
+    """アプリ終了時にバッチキューを停止する"""
+    await batch_queue.stop()
+
+
 @app.post("/analyze", response_model=AnalyzeResponse)
 async def analyze_tea(file: UploadFile = File(...)) -> AnalyzeResponse:
     """茶葉画像を分析する"""
@@ -94,43 +372,47 @@ async def analyze_tea(file: UploadFile = File(...)) -> AnalyzeResponse:
 
     try:
         # ファイルサイズの検証（5MB以下）
-        contents = await file.read()
+        # 全体をバッファしてから検証するのではなく、チャンク単位で読みながら
+        # 上限を超えた時点で即座に打ち切る
+        buf = bytearray()
+        while chunk := await file.read(65536):
+            buf.extend(chunk)
+            if len(buf) > 5 * 1024 * 1024:  # 5MB
+                raise HTTPException(status_code=400, detail=_ERR_OVERSIZE)
+
+        contents = bytes(buf)
         file_size = len(contents)
         logger.info("ファイルサイズ: %.2fMB", file_size / 1024 / 1024)
 
-        if file_size > 5 * 1024 * 1024:  # 5MB
-            raise HTTPException(status_code=400, detail="ファイルサイズは5MB以下にしてください")
-
-        # 画像を読み込む
-        try:
-            image = Image.open(io.BytesIO(contents))
-            logger.debug("画像フォーマット: %s, サイズ: %s, モード: %s", image.format, image.size, image.mode)
-        except Exception as err:  # pylint: disable=broad-except
-            log_and_raise_http_error("画像の読み込みに失敗しました", err, 400)
-
-        # 画像フォーマットの検証
-        if image.format not in ["JPEG", "PNG"]:
-            raise HTTPException(status_code=400, detail="JPEGまたはPNG形式の画像のみ対応しています")
+        # 同一内容の再アップロードはデコード・リサイズをスキップする
+        cache_key = hashlib.sha256(contents).digest()
+        cached = analyze_cache.get(cache_key)
+        if cached is not None:
+            logger.info("キャッシュヒット: %s", file.filename)
+            return cached
 
-        # 画像の最適化
-        try:
-            image = optimize_image(image)
-        except Exception as err:  # pylint: disable=broad-except
-            log_and_raise_http_error("画像の最適化に失敗しました", err, 500)
+        # デコード・リサイズはCPUバウンドなので、バッチキュー経由で
+        # ワーカースレッドにまとめて投入する
+        image_format, image_size = await batch_queue.submit(contents)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("デコード完了 - フォーマット: %s, サイズ: %s", image_format, image_size)
 
         # モック推論処理
         try:
-            variety = random.choice(TEA_VARIETIES)
-            grade = random.choice(TEA_GRADES)
-            confidence = random.uniform(0.7, 1.0)
-
-            result = AnalyzeResponse(
-                variety=variety,
-                grade=grade,
-                confidence=round(confidence, 3),
+            idx = next(_RING_COUNTER) & (_RING_SIZE - 1)
+            variety_idx, grade_idx, confidence = _RING[idx]
+
+            # 値は既知のリストと事前生成済みの数値なのでバリデーションを省略する
+            result = AnalyzeResponse.model_construct(
+                variety=TEA_VARIETIES[int(variety_idx)],
+                grade=TEA_GRADES[int(grade_idx)],
+                confidence=float(confidence),
             )
             logger.info("分析結果: %s", result.model_dump())
 
+            async with analyze_cache_lock:
+                analyze_cache[cache_key] = result
+
             return result
         except Exception as err:  # pylint: disable=broad-except
             log_and_raise_http_error("分析処理に失敗しました", err, 500)
@@ -146,6 +428,6 @@ async def health_check() -> HealthResponse:
     """ヘルスチェックエンドポイント"""
     logger.debug("ヘルスチェックリクエストを受信")
     try:
-        return HealthResponse(status="healthy", message="サーバーは正常に動作しています")
+        return HealthResponse.model_construct(status="healthy", message="サーバーは正常に動作しています")
     except Exception as err:  # pylint: disable=broad-except
         log_and_raise_http_error("Internal Server Error", err, 500)
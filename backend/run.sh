@@ -1,3 +1,6 @@
 #!/bin/bash
 source .venv/bin/activate
-uvicorn main:app --reload --port 3333 --host 0.0.0.0 
\ No newline at end of file
+# uvloop + httptoolsで高速なイベントループ・HTTPパーサを使い、
+# CPUコア数分のワーカーでデコード処理をコア間に分散する
+WORKERS=${WORKERS:-$(python3 -c 'import os; print(os.cpu_count() or 1)')}
+uvicorn main:app --port 3333 --host 0.0.0.0 --workers "$WORKERS" --loop uvloop --http httptools